@@ -0,0 +1,268 @@
+# benchmark.py
+'''
+Offline accuracy vs latency benchmark for the classifier backends.
+
+    python benchmark.py                                     # fallback, plus recorded once there are recordings
+    python benchmark.py --backend recorded --backend fallback
+    python benchmark.py --backend live --record             # call OpenAI and save its answers for later replays
+    python benchmark.py --backend mymodel:classify          # any local model exposing classify(text) -> eval type
+    python benchmark.py --backend recorded --compare benchmarks/recorded-20261019-120000.json
+
+The corpus is a tab separated file of `label<TAB>text` lines in the style of the SMS Spam Collection, where the
+label is `ham`, `spam`, `violent`, `harassment`, `nsfw`, `hate_speech` or `other`. Keep the prompt's few-shot
+examples out of the corpus, the LLM has already seen their answers. Like eval_text, every backend is preceded by
+the link blocklist check unless --no-blocklist is given.
+'''
+import argparse
+import importlib
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from classifier import request_classification, parse_classification, fallback_classification
+from links import LinkReputation
+
+CORPUS_PATH = "benchmark_corpus.tsv"
+RECORDED_PATH = "benchmark_recorded.json"
+RESULTS_DIR = "benchmarks"
+
+
+def label_of(eval_type):
+    '''
+    Reduces an eval type like violation_spam_links_serious to the corpus label it should be scored against.
+    '''
+    if "violation" not in eval_type:
+        return "ham"
+    label = eval_type[len("violation_"):].replace(' ', '_')
+    for suffix in ["_serious", "_minor"]:
+        if label.endswith(suffix):
+            label = label[:-len(suffix)]
+    if label.startswith("spam"):
+        return "spam"
+    return label
+
+
+def load_corpus(path):
+    corpus = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            label, text = line.split('\t', 1)
+            corpus.append((label, text))
+    return corpus
+
+
+class FallbackBackend:
+    name = "fallback"
+
+    def classify(self, text):
+        return fallback_classification(text)
+
+
+class RecordedBackend:
+    '''
+    Replays LLM answers saved by a `--record` run through the same parser eval_text uses, so prompt parsing
+    changes can be measured without calling OpenAI. With simulate_latency the recorded call time is slept too.
+    '''
+    name = "recorded"
+
+    def __init__(self, path=RECORDED_PATH, simulate_latency=False):
+        if not os.path.isfile(path):
+            raise SystemExit(f"No recorded responses in {path}, run with --backend live --record first")
+        with open(path) as f:
+            self.recordings = json.load(f)
+        self.simulate_latency = simulate_latency
+
+    def classify(self, text):
+        if text not in self.recordings:
+            raise KeyError(f"No recorded response for {text!r}, run with --backend live --record first")
+        recording = self.recordings[text]
+        if self.simulate_latency:
+            time.sleep(recording["latency"])
+        return parse_classification(recording["output"])
+
+
+class LiveBackend:
+    '''
+    Calls OpenAI with the bot's prompt, retrying like eval_text does. With record, every answer and its latency
+    is saved for RecordedBackend. It isn't run a second time for the memory pass, that would mean paying twice.
+    '''
+    name = "live"
+    repeatable = False
+
+    def __init__(self, record=False, path=RECORDED_PATH):
+        from bot import load_tokens
+        import openai
+        self.openai = openai
+        tokens = load_tokens()
+        self.openai.organization = tokens['openai_org']
+        self.openai.api_key = tokens['openai']
+        self.record = record
+        self.path = path
+        self.recordings = {}
+        if record and os.path.isfile(path):
+            with open(path) as f:
+                self.recordings = json.load(f)
+
+    def classify(self, text):
+        started = time.perf_counter()
+        output = request_classification(self.openai, text)
+        if output is None:
+            raise RuntimeError(f"OpenAI could not classify {text!r}")
+        if self.record:
+            self.recordings[text] = {"output": output, "latency": time.perf_counter() - started}
+        return parse_classification(output)
+
+    def close(self):
+        if self.record:
+            with open(self.path, "w") as f:
+                json.dump(self.recordings, f, indent=2)
+
+
+class FunctionBackend:
+    '''
+    Wraps a local model given as `module:function`, where the function maps text to an eval type.
+    '''
+    def __init__(self, spec):
+        module, _, function = spec.partition(':')
+        self.name = spec
+        self.classify = getattr(importlib.import_module(module), function)
+
+
+def make_backend(name, args):
+    if name == "fallback":
+        return FallbackBackend()
+    if name == "recorded":
+        return RecordedBackend(args.recorded, args.simulate_latency)
+    if name == "live":
+        return LiveBackend(args.record, args.recorded)
+    if ':' in name:
+        return FunctionBackend(name)
+    raise ValueError(f"Unknown backend {name}")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def score(labels, predictions):
+    per_label = {}
+    for label in sorted(set(labels) | set(predictions)):
+        tp = sum(1 for l, p in zip(labels, predictions) if l == label and p == label)
+        fp = sum(1 for l, p in zip(labels, predictions) if l != label and p == label)
+        fn = sum(1 for l, p in zip(labels, predictions) if l == label and p != label)
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        per_label[label] = {"precision": precision, "recall": recall, "f1": f1, "support": tp + fn}
+    supported = [m for m in per_label.values() if m["support"]]
+    return {
+        "accuracy": sum(1 for l, p in zip(labels, predictions) if l == p) / len(labels),
+        "macro_f1": statistics.mean(m["f1"] for m in supported) if supported else 0.0,
+        "labels": per_label,
+    }
+
+
+def classify_all(backend, corpus, reputation):
+    labels, predictions, latencies = [], [], []
+    started = time.perf_counter()
+    for label, text in corpus:
+        call_started = time.perf_counter()
+        # Same order as eval_text: blocklisted links are flagged before the backend is asked
+        if reputation is not None and reputation.blocklisted(text):
+            eval_type = "violation_spam_links_serious"
+        else:
+            eval_type = backend.classify(text)
+        latencies.append(time.perf_counter() - call_started)
+        labels.append(label)
+        predictions.append(label_of(eval_type))
+    return labels, predictions, latencies, time.perf_counter() - started
+
+
+def run(backend, corpus, reputation=None):
+    '''
+    Latency and throughput come from a pass without tracemalloc, which would slow every allocation down.
+    Peak memory is measured in a second, traced pass, skipped for backends that shouldn't run twice (live).
+    '''
+    peak = None
+    try:
+        labels, predictions, latencies, elapsed = classify_all(backend, corpus, reputation)
+        if getattr(backend, "repeatable", True):
+            tracemalloc.start()
+            try:
+                classify_all(backend, corpus, reputation)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+    finally:
+        # Keep whatever a --record run got through, even if it fails partway
+        if hasattr(backend, "close"):
+            backend.close()
+
+    results = score(labels, predictions)
+    results.update({
+        "backend": backend.name,
+        "messages": len(corpus),
+        "throughput": len(corpus) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {p: percentile(latencies, int(p[1:])) * 1000 for p in ["p50", "p90", "p99"]},
+        "peak_memory_kib": peak / 1024 if peak is not None else None,
+    })
+    return results
+
+
+def report(results, previous=None):
+    print(f"== {results['backend']}: {results['messages']} messages")
+    print(f"accuracy {results['accuracy']:.3f}  macro f1 {results['macro_f1']:.3f}  "
+          f"throughput {results['throughput']:.1f} msg/s  peak memory " +
+          (f"{results['peak_memory_kib']:.0f}KiB" if results['peak_memory_kib'] is not None else "not measured"))
+    print("latency " + "  ".join(f"{p} {ms:.2f}ms" for p, ms in results['latency_ms'].items()))
+    print(f"{'label':<12} {'precision':>9} {'recall':>7} {'f1':>6} {'support':>7}")
+    for label, m in results['labels'].items():
+        print(f"{label:<12} {m['precision']:>9.3f} {m['recall']:>7.3f} {m['f1']:>6.3f} {m['support']:>7}")
+    if previous is not None:
+        print(f"vs {previous['backend']}: "
+              f"accuracy {results['accuracy'] - previous['accuracy']:+.3f}  "
+              f"macro f1 {results['macro_f1'] - previous['macro_f1']:+.3f}  "
+              f"p50 {results['latency_ms']['p50'] - previous['latency_ms']['p50']:+.2f}ms  "
+              f"throughput {results['throughput'] - previous['throughput']:+.1f} msg/s")
+
+
+def save(results):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = results['backend'].replace(':', '-').replace('.', '-')
+    path = os.path.join(RESULTS_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", action="append", help="fallback, recorded, live or module:function (repeatable)")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--recorded", default=RECORDED_PATH, help="recorded LLM responses to replay or record into")
+    parser.add_argument("--record", action="store_true", help="save live responses for the recorded backend")
+    parser.add_argument("--simulate-latency", action="store_true", help="sleep for the recorded call time on replay")
+    parser.add_argument("--no-blocklist", action="store_true", help="measure the backends without the link blocklist check")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    reputation = None if args.no_blocklist else LinkReputation()
+    backends = args.backend or (["fallback", "recorded"] if os.path.isfile(args.recorded) else ["fallback"])
+    for name in backends:
+        results = run(make_backend(name, args), corpus, reputation)
+        report(results, previous)
+        print(f"saved to {save(results)}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,76 @@
 # bot.py
 import discord
-from discord.ext import commands
 import os
 import json
+import asyncio
 import logging
 import re
-import requests
+import collections
 from report import State, Category, SpamType, Report
-import pdb
-import os
-import openai
-import time
-
-# Set up logging to the console
-logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
+from sweep import HistorySweep
+from links import LinkReputation, GOOD, BAD, extract_links
+from scheduler import IngressScheduler
+from profiler import LiveProfiler
+from classifier import request_classification, parse_classification, fallback_classification
 
 # There should be a file called 'tokens.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    openai_token = tokens['openai']
-    openai_org = tokens['openai_org']
+TOKEN_PATH = 'tokens.json'
+
 
+def setup_logging():
+    # Set up logging to the console
+    logger = logging.getLogger('discord')
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    logger.addHandler(handler)
 
-openai.organization = openai_org
-openai.api_key = openai_token
+
+def load_tokens(token_path=TOKEN_PATH):
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        return json.load(f)
 
 
 class ModBot(discord.Client):
-    def __init__(self): 
+    CLASSIFICATION_CACHE_SIZE = 4096
+    # Reports moderators can see: queued, waiting for a second opinion, or partway through the mod flow
+    OPEN_REPORT_STATES = [State.AWAITING_MOD, State.AWAITING_SECOND_MOD, State.AWAITING_SECOND_MOD_CONFIRM,
+                          State.AWAITING_MOD_CONFIRM, State.AWAITING_MOD_CLASSIFICATION, State.AWAITING_MOD_SUBCLASSIFICATION,
+                          State.AWAITING_MOD_SEVERITY, State.AWAITING_MOD_LINK_INVOLVE, State.AWAITING_MOD_LINK_LEGIT,
+                          State.AWAITING_MOD_MINOR_SPAM, State.AWAITING_MOD_LINK_SERIOIUS, State.AWAITING_MOD_REPEATED]
+
+    def __init__(self, tokens=None):
         intents = discord.Intents.default()
         intents.message_content = True
         # intents.messages = True 
         super().__init__(command_prefix='.', intents=intents)
+        self.tokens = tokens or {}
+        self.openai = None  # Imported on first use or by warm_up_classifier, see get_openai
         self.group_num = None
         self.mod_channels = {} # Map from guild to the mod channel id for that guild
+        self.indexed_guilds = set()  # Guilds already searched for a mod channel, whether or not they have one
         self.reports = {}  # Map from user IDs to the state of their report
         self.moderation_actions = {}
-        self.responses = json.load(open("response.json"))
-        self.report_history = json.load(open("report_history.json"))
+        with open("response.json") as f:
+            self.responses = json.load(f)
+        with open("report_history.json") as f:
+            self.report_history = json.load(f)
         self.next_report_id = 0
+        self.sweeps = {}  # Map from channel id to the history sweep running over it
+        self.link_reputation = LinkReputation()
+        self.scheduler = IngressScheduler()
+        self.profiler = LiveProfiler()
+        self.classification_cache = collections.OrderedDict()  # LRU map from message content to eval_text result
+
+    async def setup_hook(self):
+        # setup_hook runs after login but before the gateway connects, so the bot's name is already known
+        self.parse_group_num()
+        self.scheduler.start()
+        # Import and connect the classifier while the gateway handshake is in progress
+        self.warm_up_task = asyncio.create_task(self.warm_up_classifier())
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -55,6 +78,12 @@ class ModBot(discord.Client):
             print(f' - {guild.name}')
         print('Press Ctrl-C to quit.')
 
+        # Guilds normally arrive through on_guild_available before this; only index any that didn't
+        for guild in self.guilds:
+            if guild.id not in self.indexed_guilds:
+                self.index_guild(guild)
+
+    def parse_group_num(self):
         # Parse the group number out of the bot's name
         match = re.search('[gG]roup (\d+) [bB]ot', self.user.name)
         if match:
@@ -62,12 +91,66 @@ class ModBot(discord.Client):
         else:
             raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
 
-        # Find the mod channel in each guild that this bot should report to
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
-        
+    def mod_channel_name(self):
+        return f'group-{self.group_num}-mod'
+
+    def index_guild(self, guild):
+        # Find the mod channel in this guild that this bot should report to
+        channel = discord.utils.get(guild.text_channels, name=self.mod_channel_name())
+        if channel is not None:
+            self.mod_channels[guild.id] = channel
+        self.indexed_guilds.add(guild.id)
+
+    # The mod channel index is kept up to date from guild and channel events instead of scanning every guild on ready
+    async def on_guild_available(self, guild):
+        self.index_guild(guild)
+
+    async def on_guild_join(self, guild):
+        self.index_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.mod_channels.pop(guild.id, None)
+        self.indexed_guilds.discard(guild.id)
+
+    async def on_guild_unavailable(self, guild):
+        self.mod_channels.pop(guild.id, None)
+        self.indexed_guilds.discard(guild.id)
+
+    async def on_guild_channel_create(self, channel):
+        if channel.name == self.mod_channel_name() and isinstance(channel, discord.TextChannel):
+            self.mod_channels[channel.guild.id] = channel
+
+    async def on_guild_channel_delete(self, channel):
+        if self.mod_channels.get(channel.guild.id) == channel:
+            self.mod_channels.pop(channel.guild.id)
+            self.index_guild(channel.guild)
+
+    async def on_guild_channel_update(self, before, after):
+        if before.name != after.name:
+            if self.mod_channels.get(after.guild.id) == after:
+                self.mod_channels.pop(after.guild.id)
+            self.index_guild(after.guild)
+
+    def get_openai(self):
+        '''
+        The openai module is slow to import, so it is only loaded (and configured) the first time it's needed.
+        '''
+        if self.openai is None:
+            import openai
+            openai.organization = self.tokens.get('openai_org')
+            openai.api_key = self.tokens.get('openai')
+            self.openai = openai
+        return self.openai
+
+    async def warm_up_classifier(self):
+        loop = asyncio.get_running_loop()
+        try:
+            openai = await loop.run_in_executor(None, self.get_openai)
+            # A cheap request opens the HTTPS connection so the first real classification doesn't pay for it
+            await loop.run_in_executor(None, openai.Model.list)
+            print("[log] classifier warmed up")
+        except Exception as e:
+            print(f"[log] classifier warm up failed: {e!r}")
 
     async def on_message(self, message):
         '''
@@ -78,15 +161,116 @@ class ModBot(discord.Client):
         if message.author.id == self.user.id:
             return
 
-        # Check if this message was sent in a server ("guild") or if it's a DM
+        # Check if this message was sent in a server ("guild") or if it's a DM, and queue it on the matching lane
         if message.guild:
             if "mod" in message.channel.name:
-                await self.handle_mod_channel_message(message)
+                await self.scheduler.submit(IngressScheduler.MOD, message.author.id, self.handle_mod_channel_message, message)
             else:
-                await self.handle_channel_message(message)
+                await self.scheduler.submit(IngressScheduler.CHANNEL, message.author.id, self.handle_channel_message, message)
+        else:
+            await self.scheduler.submit(IngressScheduler.DM, message.author.id, self.handle_dm, message)
+
+
+    async def on_raw_message_edit(self, payload):
+        '''
+        Raw events fire even when the edited message isn't in the client's message cache.
+        Reclassification can be slow, so it goes on the channel lane like new messages do.
+        '''
+        if payload.guild_id is None or 'content' not in payload.data:
+            return
+        author = payload.data.get('author', {})
+        if self.user is not None and author.get('id') == str(self.user.id):
+            return
+        await self.scheduler.submit(IngressScheduler.CHANNEL, payload.message_id, self.handle_message_edit, payload)
+
+    async def on_raw_message_delete(self, payload):
+        if payload.guild_id is None:
+            return
+        await self.handle_message_delete(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        # Moderators purging raid spam delete in bulk
+        if payload.guild_id is None:
+            return
+        for message_id in payload.message_ids:
+            await self.handle_message_delete(message_id)
+
+    def reports_for_message(self, message_id):
+        '''
+        Open reports about the message: those moderators can see, plus those still being classified.
+        Cancelled reports and reports still in the reporter's DM flow are left alone.
+        '''
+        return [report for report in self.reports.values()
+                if report.message is not None and report.message.id == message_id
+                and (report.classifying or report.state in self.OPEN_REPORT_STATES)]
+
+    def material_change(self, before, after):
+        '''
+        An edit is material unless it leaves the same words in the same order once case, whitespace and
+        punctuation are ignored. Even a short appended sentence is reclassified; classify() caches by content.
+        '''
+        if before is None:
+            return True
+        if set(extract_links(before)) != set(extract_links(after)):
+            return True
+        return re.findall(r'\w+', before.lower()) != re.findall(r'\w+', after.lower())
+
+    async def handle_message_edit(self, payload):
+        content = payload.data['content']
+        reports = self.reports_for_message(payload.message_id)
+        if payload.cached_message is not None:
+            before = payload.cached_message.content
+        elif reports:
+            before = reports[0].message.content
         else:
-            await self.handle_dm(message)
+            before = None
+        if not self.material_change(before, content):
+            return
 
+        channel = self.get_channel(payload.channel_id)
+        scanned_channel = channel is not None and channel.name == f'group-{self.group_num}'
+        # Only edits we'd act on are worth a classifier call
+        if not reports and not scanned_channel:
+            return
+        mod_channel = self.mod_channels.get(payload.guild_id)
+        if mod_channel is None:
+            return
+        eval_type = await self.classify(content)
+
+        # Keep open reports pointing at what the message says now
+        for report in reports:
+            report.message.content = content
+            if report.classifying:
+                # Not announced to moderators yet; handle_dm publishes it with the classification it is computing
+                continue
+            if report.state == State.AWAITING_MOD:
+                report.eval_type = eval_type
+                report.priority_score = self.priority_score(eval_type, report.reported_author_id)
+            await mod_channel.send(f'The message in report {report.id} was edited and is now classified as {eval_type}.')
+
+        if scanned_channel:
+            author = payload.data.get('author', {}).get('username', 'unknown')
+            await mod_channel.send(f'Edited message:\n{author}: "{content}"')
+            await mod_channel.send(self.code_format(eval_type))
+
+    async def handle_message_delete(self, message_id):
+        for report in self.reports_for_message(message_id):
+            mod_channel = self.mod_channels.get(report.message.guild.id)
+            if report.classifying:
+                # Moderators haven't been told about this report yet, only the reporter needs to know.
+                # handle_dm sees it is gone once classification finishes and doesn't publish it.
+                report.state = State.MOD_COMPLETE
+                self.reports.pop(report.reporter_author_id)
+                await report.reporter_channel.send("[Report Result]: The message you reported has been deleted. Thank you for your report!")
+            elif report.state == State.AWAITING_MOD:
+                # Nobody has picked the report up yet, so close it instead of letting moderation fail on it later
+                report.state = State.MOD_COMPLETE
+                self.reports.pop(report.reporter_author_id)
+                await report.reporter_channel.send("[Report Result]: The message you reported has been deleted. Thank you for your report!")
+                if mod_channel is not None:
+                    await mod_channel.send(f'Report {report.id} was closed because its message was deleted.')
+            elif mod_channel is not None and report.reporter_channel is not None:
+                await mod_channel.send(f'The message in report {report.id} was deleted; moderation can continue from the copy we have.')
 
     async def handle_moderation(self, report, eval_result):
         if "second" in eval_result:
@@ -198,6 +382,9 @@ class ModBot(discord.Client):
                 await mod_channel.send("I'm sorry, I didn't understand that. Reply with 'yes' or 'no.' \n")
                 return
             if message.content == "yes":
+                if report.link_legit is False:
+                    # Only a confirmed "not legitimate" answer marks the links bad for future reports
+                    self.link_reputation.record(report.message.content, False)
                 report.eval_type = report.eval_type.replace("second", "permban")
                 await mod_channel.send("Thank you. Finalizing evaluation.")  # original 
                 print(report.eval_type)  # original 
@@ -289,8 +476,7 @@ class ModBot(discord.Client):
                 await mod_channel.send("Is there a link in the message? type 'yes' or 'no'")
                 return
             elif message.content in [SpamType.LINKS]:
-                report.state = State.AWAITING_MOD_LINK_LEGIT
-                await mod_channel.send("Is the link legitimate? type 'yes' or 'no'")
+                await self.ask_link_legit(report, mod_channel)
                 return
             elif message.content in [SpamType.TROLL, SpamType.HUMAN]:
                 report.state = State.AWAITING_MOD_MINOR_SPAM
@@ -307,8 +493,7 @@ class ModBot(discord.Client):
                 await mod_channel.send("Please type 'yes' or 'no'")
                 return
             if message.content == "yes":
-                report.state = State.AWAITING_MOD_LINK_LEGIT
-                await mod_channel.send("Is the link legitimate? type 'yes' or 'no'")
+                await self.ask_link_legit(report, mod_channel)
                 return
             else:
                 report.state = State.AWAITING_MOD_LINK_SERIOIUS
@@ -322,7 +507,9 @@ class ModBot(discord.Client):
             if message.content not in ['yes', 'no']:
                 await mod_channel.send("Please type 'yes' or 'no'")
                 return
-            if message.content == "yes":
+            report.link_legit = message.content == "yes"
+            if report.link_legit:
+                self.link_reputation.record(report.message.content, True)
                 report.state = State.AWAITING_MOD_LINK_SERIOIUS
                 await mod_channel.send("Is this a serioius spam? type 'yes' or 'no'")
                 return
@@ -374,6 +561,23 @@ class ModBot(discord.Client):
             self.reports.pop(self.moderation_actions[author_id].reporter_author_id)
             self.moderation_actions.pop(author_id)
 
+    async def ask_link_legit(self, report, mod_channel):
+        '''
+        Only asks the moderator whether the links are legitimate if we haven't seen them before.
+        Links already judged legitimate go straight to the severity question, known-bad links to a second opinion.
+        '''
+        verdict = self.link_reputation.check(report.message.content)
+        if verdict == GOOD:
+            report.state = State.AWAITING_MOD_LINK_SERIOIUS
+            await mod_channel.send("The links in this message were previously judged legitimate. Is this a serioius spam? type 'yes' or 'no'")
+        elif verdict == BAD:
+            report.eval_type += "_second"
+            await mod_channel.send("The message contains a known-bad link. Second moderator opinion requested. Thank you. Finalizing evaluation.")
+            await self.handle_moderation(report, report.eval_type)
+        else:
+            report.state = State.AWAITING_MOD_LINK_LEGIT
+            await mod_channel.send("Is the link legitimate? type 'yes' or 'no'")
+
     async def handle_dm(self, message):
         # Handle a help message
         if message.content == Report.HELP_KEYWORD:
@@ -399,34 +603,39 @@ class ModBot(discord.Client):
             await message.channel.send(r)
 
         # violation detection
-        if self.reports[author_id].state == State.REPORT_COMPLETE and message.content != self.reports[author_id].CANCEL_KEYWORD:
-            self.reports[author_id].state = State.AWAITING_MOD
+        report = self.reports[author_id]
+        if report.state == State.REPORT_COMPLETE and message.content != report.CANCEL_KEYWORD:
             # record report history for this user
-            reported_id = self.reports[author_id].message.author.id
+            reported_id = report.message.author.id
             if reported_id not in self.report_history:
                 self.report_history[reported_id] = [0, 0] # reported, confirmed violation
             
             self.report_history[reported_id][0] += 1
             # None spam report, detect and reply
-            self.reports[author_id].reporter_channel = message.channel
-            self.reports[author_id].reporter_author_id = author_id
-
-            self.reports[author_id].eval_type = self.eval_text(self.reports[author_id].message.content)
+            report.reporter_channel = message.channel
+            report.reporter_author_id = author_id
+
+            # The report only becomes visible to moderators (AWAITING_MOD) once it is classified and scored
+            report.classifying = True
+            eval_type = await self.classify(report.message.content)
+            report.classifying = False
+            if self.reports.get(author_id) is not report:
+                # handle_message_delete closed the report while we were classifying
+                with open("report_history.json", "w") as f:
+                    json.dump(self.report_history, f)
+                return
+            report.eval_type = eval_type
 
             # compute priority score
-            auto_score = 0.0 if "violation" not in self.reports[author_id].eval_type else (
-                1.0 if "serious" in self.reports[author_id].eval_type else 0.5
-            )
-            self.reports[author_id].priority_score = 1.0 * auto_score + 0.2 * self.report_history[reported_id][1] + 0.1 * self.report_history[reported_id][0]
-            # self.reports[author_id].priority_score += (10.0 if "second" in self.reports[author_id].eval_type else 0.0)
+            report.priority_score = self.priority_score(report.eval_type, reported_id)
 
-            print("Auto score: ", auto_score)
             print("Confirmed: ", self.report_history[reported_id][1])
             print("reported: ", self.report_history[reported_id][0])
-            print("Overall score: ", self.reports[author_id].priority_score)
+            print("Overall score: ", report.priority_score)
 
+            report.state = State.AWAITING_MOD
             mod_channel = list(self.mod_channels.values())[0]
-            await mod_channel.send(f'Report {self.reports[author_id].id} requires moderation')
+            await mod_channel.send(f'Report {report.id} requires moderation')
 
         # record report history
         with open("report_history.json", "w") as f:
@@ -440,7 +649,7 @@ class ModBot(discord.Client):
         # Forward the message to the mod channel
         mod_channel = self.mod_channels[message.guild.id]
         await mod_channel.send(f'Forwarded message:\n{message.author.name}: "{message.content}"')
-        scores = self.eval_text(message.content)
+        scores = await self.classify(message.content)
         await mod_channel.send(self.code_format(scores))
 
     async def handle_mod_channel_message(self, message):
@@ -452,131 +661,163 @@ class ModBot(discord.Client):
         mod_channel = self.mod_channels[message.guild.id]
         
         author_id = message.author.id
+        if message.content == IngressScheduler.STATUS_KEYWORD:
+            await mod_channel.send(self.code_format(self.scheduler.status()))
+            return
+        if message.content.startswith(LiveProfiler.PROFILE_KEYWORD):
+            await self.handle_profile_command(message, mod_channel)
+            return
+        if message.content.startswith(HistorySweep.SWEEP_KEYWORD):
+            await self.handle_sweep_command(message, mod_channel)
+            return
         if author_id in self.moderation_actions or message.content.startswith(Report.MOD_KEYWORD):
             await self.handle_mod_flow(message)
             return
+
+    async def handle_sweep_command(self, message, mod_channel):
+        '''
+        `sweep <channel>` starts (or resumes) a background sweep of that channel's history,
+        `sweep restart <channel>` sweeps it again from the first message,
+        `sweep status` reports progress of every sweep and `sweep stop <channel>` cancels one.
+        '''
+        usage = "Usage: `sweep <channel>`, `sweep restart <channel>`, `sweep status` or `sweep stop <channel>`"
+        args = message.content.split()[1:]
+        if not args:
+            await mod_channel.send(usage)
+            return
+        if args[0] == "status":
+            running = [sweep.status() for sweep in self.sweeps.values() if sweep.running()]
+            await mod_channel.send("\n".join(running) if running else "No sweeps are running.")
+            return
+
+        action = args[0] if args[0] in ["stop", "restart"] else None
+        if action is not None and len(args) < 2:
+            await mod_channel.send(usage)
+            return
+        name = (args[1] if action else args[0]).lstrip('#')
+        channel = discord.utils.get(message.guild.text_channels, name=name)
+        if channel is None:
+            await mod_channel.send(f"I couldn't find a channel called #{name}.")
+            return
+
+        sweep = self.sweeps.get(channel.id)
+        if action == "stop":
+            if sweep is None or not sweep.running():
+                await mod_channel.send(f"No sweep is running over #{name}.")
+            else:
+                sweep.stop()
+            return
+        if sweep is not None and sweep.running():
+            await mod_channel.send(sweep.status())
+            return
+        self.sweeps[channel.id] = HistorySweep(self, channel, mod_channel, restart=action == "restart")
+        self.sweeps[channel.id].start()
+
+    async def handle_profile_command(self, message, mod_channel):
+        '''
+        `profile <seconds>` profiles the running bot and posts the results to the mod channel, `profile stop` ends it early.
+        `profile <seconds> alloc` also traces allocation sites, at a noticeable cost while it runs.
+        '''
+        args = message.content.split()[1:]
+        if args == ['stop']:
+            self.profiler.stop()
+            return
+        if len(args) not in [1, 2] or not args[0].isdigit() or args[1:] not in [[], ['alloc']]:
+            await mod_channel.send("Usage: `profile <seconds> [alloc]` or `profile stop`")
+            return
+        if self.profiler.running():
+            await mod_channel.send("A profile is already running.")
+            return
+        task = self.profiler.start(int(args[0]), trace_allocations=args[1:] == ['alloc'])
+        await mod_channel.send(f"Profiling for {args[0]} seconds.")
+        # Post the results from a separate task so the mod lane isn't held up while profiling
+        self.profile_report_task = asyncio.create_task(self.send_profile(task, mod_channel))
+
+    async def send_profile(self, task, mod_channel):
+        try:
+            path, summary_path, summary = await task
+        except asyncio.CancelledError:
+            await mod_channel.send("Profiling was cancelled.")
+            return
+        except Exception as e:
+            logging.getLogger('discord').exception("Profiling failed")
+            await mod_channel.send(f"Profiling failed: {e!r}")
+            return
+        # Discord messages are limited to 2000 characters, the full summary is attached next to the stacks
+        await mod_channel.send(f"Profile written to {path}\n```{summary[:1800]}```",
+                               files=[discord.File(path), discord.File(summary_path)])
+
+    def queue_flagged_message(self, message, eval_type, mod_channel):
+        '''
+        Puts a message flagged by the classifier (rather than by a user) into the moderation queue and returns
+        the new report. The mod channel stands in for the reporter so the outcome is posted there; the caller
+        announces the report.
+        '''
+        report = Report(self)
+        report.state = State.AWAITING_MOD
+        report.message = message
+        report.channel = message.channel
+        report.reported_author_id = message.author.id
+        report.reporter_channel = mod_channel
+        report.reporter_author_id = ("auto", message.id)
+        report.eval_type = eval_type
+
+        reported_id = message.author.id
+        if reported_id not in self.report_history:
+            self.report_history[reported_id] = [0, 0] # reported, confirmed violation
+        report.priority_score = self.priority_score(eval_type, reported_id)
+        self.reports[report.reporter_author_id] = report
+        print(f"[log] queued report {report.id} for message {message.id}: {eval_type}")
+        return report
     
+    def priority_score(self, eval_type, reported_id):
+        auto_score = 0.0 if "violation" not in eval_type else (1.0 if "serious" in eval_type else 0.5)
+        return 1.0 * auto_score + 0.2 * self.report_history[reported_id][1] + 0.1 * self.report_history[reported_id][0]
+
+    async def classify(self, message):
+        '''
+        eval_text blocks on the OpenAI call, so run it in a thread to keep the event loop free for other lanes.
+        Results are cached by content, so reposted or re-checked text costs nothing. Keyword fallback results are
+        not cached, so text classified during an OpenAI outage gets a proper answer next time.
+        '''
+        if message in self.classification_cache:
+            self.classification_cache.move_to_end(message)
+            return self.classification_cache[message]
+        loop = asyncio.get_running_loop()
+        async with self.profiler.timed("eval_text"):
+            result, used_fallback = await loop.run_in_executor(None, self.eval_text_with_source, message)
+        if not used_fallback:
+            self.classification_cache[message] = result
+            if len(self.classification_cache) > self.CLASSIFICATION_CACHE_SIZE:
+                self.classification_cache.popitem(last=False)
+        return result
+
     def eval_text(self, message):
         ''''
         TODO: Once you know how you want to evaluate messages in your channel, 
         insert your code here! This will primarily be used in Milestone 3. 
         '''
-        retry = True
-        retries = 0
-        while retry and retries < 5:
-            retries += 1
-            retry = False
-            try:
-                response = openai.ChatCompletion.create(
-                    model="gpt-4",# "gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "You are a content moderation system for online social media and SMS messages. Classify each message as flagged or not flagged."
-                            "Messages should be flagged if they are spam, violent, harssment, not safe for work, hate speech, or otherwise violate content policy. Also classify a message as Other violation if the message contains the keyword 'cs152'."
-                            "If the message is flagged, make a determination if it is a serious violation or non-serious violation. Messages with malicious intent or has potential negative impact on the receiver should be classified as serious."
-                            "If it is spam, classify it as advertising, invites to other platforms, malicious links, or other."
-                            "Additionally, if the message is spam, classify it as serious if it contains any link, Discord invite, or any form of advertising. Otherwise, it is non-serious spam."
-                            "Your response should only contain keywords in [Flagged, Not flagged, Spam, Violent, Harrasment, Not safe for work, nsfw, Hate speech, Other, Non-serious, Serious, Advertising, Invites, Links"},
-                        {"role": "user", "content": "Join my crypto discord server: https://discord.gg/XYBrZE8x."},
-                        {"role": "assistant", "content": "Flagged. Spam. Non-serious. Invites."},
-                        {"role": "user", "content": "We should play Call Of Duty Together."},
-                        {"role": "assistant", "content": "Not flagged."},
-                        {"role": "user", "content": "I'm going to kick your ass."},
-                        {"role": "assistant", "content": "Flagged. Violent. Serious."},
-                        {"role": "user", "content": "Free entry in 2 a wkly comp to win FA Cup final tkts 21st May 2005. Text FA to 87121 to receive entry question(std txt rate)T&C's apply 08452810075over18's"},
-                        {"role": "assistant", "content": "Flagged. Spam. Serious. Advertising."},
-                        {"role": "user", "content": "XXXMobileMovieClub: To use your credit, click the WAP link in the next txt message or click here>> http://wap. xxxmobilemovieclub.com?n=QJKGIGHJJGCBL"},
-                        {"role": "assistant", "content": "Flagged. Spam. Serious. Links."},
-                        {"role": "user", "content": message}
-                    ]
-                )
-
-                output = response['choices'][0]['message']['content']
-
-                print("GPT output: " + output)
-
-                classifications_list = output.split('. ')
-                if "not flagged" in classifications_list[0].lower() or len(classifications_list) < 2:
-                    return "unidentified"
-
-                classifications = output
-                result = ""
-                if "spam" in classifications.lower():
-                    if SpamType.ADVERTISING in classifications.lower():
-                        result += "violation_spam_advertising"
-                    elif SpamType.INVITES in classifications.lower():
-                        result += "violation_spam_invites"
-                    elif SpamType.MALICIOUS_LINKS in classifications.lower():
-                        result += "violation_spam_links"
-                    elif SpamType.OTHER in classifications.lower():
-                        result += "violation_spam_other"
-                    else:
-                        result += "violation_spam"
-                elif "violent" in classifications.lower():
-                    result += "violation_violent"
-                elif "harassment" in classifications.lower():
-                    result += "violation_harassment"
-                elif "not safe for work" in classifications.lower() or "nsfw" in classifications.lower():
-                    result += "violation_nsfw"
-                elif "hate speech" in classifications.lower():
-                    result += "violation_hate_speech"
-                else:
-                    result += "violation_other"
-
-                if "non-serious" in classifications.lower():
-                    result += "_minor"
-                elif "serious" in classifications.lower():
-                    result += "_serious"
+        return self.eval_text_with_source(message)[0]
 
-                print(f"GPT classification: {result}")
-                return result
-
-            except (openai.error.APIError, openai.error.Timeout, openai.error.RateLimitError):
-                retry = True
-                print("Hit a recoverable OpenAI API error. Retrying in 1 second.")
-                time.sleep(1)
+    def eval_text_with_source(self, message):
+        '''
+        Does the work for eval_text, returning (result, used_fallback) so callers can tell
+        LLM and blocklist answers apart from the keyword fallback.
+        '''
+        # Known-bad links are flagged without asking the LLM
+        if self.link_reputation.blocklisted(message):
+            print("[log] known-bad link")
+            return "violation_spam_links_serious", False
 
-            except (openai.error.APIConnectionError, 
-                    openai.errors.InvalidRequestError, 
-                    openai.errors.AuthenticationError, 
-                    openai.errors.ServiceUnavailableError
-                    ) as e:
-                print(e)
-                print("Hit unrecoverable OpenAI error. Falling back.")
+        output = request_classification(self.get_openai(), message)
+        if output is not None:
+            result = parse_classification(output)
+            print(f"GPT classification: {result}")
+            return result, False
 
         print("Activating fallback.")
-        # TBH this should be better. Let's think about how to do this.
-        result = ""
-        if Category.SPAM in message:
-            if SpamType.ADVERTISING in message:
-                result += "violation_spam_advertising"
-            elif SpamType.INVITES in message:
-                result += "violation_spam_invites"
-            elif SpamType.MALICIOUS_LINKS in message:
-                result += "violation_spam_links"
-            elif SpamType.OTHER in message:
-                result += "violation_spam_other"
-            else:
-                result += "violation_spam"
-        elif Category.VIOLENT in message:
-            result += "violation_violent"
-        elif Category.HARASSMENT in message:
-            result += "violation_harassment"
-        elif Category.NSFW in message:
-            result += "violation_nsfw"
-        elif Category.HATE_SPEECH in message:
-            result += "violation_hate speech"
-        elif Category.OTHER in message:
-            result += "violation_other"
-            
-        if "serious" in message:
-            result += "_serious"
-        else:
-            result += "_minor"
-        if "violation" in result:
-            return result
-        else:
-            return "unidentified"
-    
+        return fallback_classification(message), True
+
     def code_format(self, text):
         ''''
         TODO: Once you know how you want to show that a message has been 
@@ -590,5 +831,12 @@ class ModBot(discord.Client):
         return self.next_report_id
 
 
-client = ModBot()
-client.run(discord_token)
\ No newline at end of file
+def main():
+    setup_logging()
+    tokens = load_tokens()
+    client = ModBot(tokens)
+    client.run(tokens['discord'])
+
+
+if __name__ == "__main__":
+    main()
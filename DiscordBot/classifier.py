@@ -0,0 +1,143 @@
+# classifier.py
+import time
+from report import Category, SpamType
+
+# Kept apart from the client and openai so the classifier can be benchmarked offline (see benchmark.py)
+MODEL = "gpt-4" # "gpt-3.5-turbo"
+
+PROMPT = [
+    {"role": "system", "content": "You are a content moderation system for online social media and SMS messages. Classify each message as flagged or not flagged."
+        "Messages should be flagged if they are spam, violent, harssment, not safe for work, hate speech, or otherwise violate content policy. Also classify a message as Other violation if the message contains the keyword 'cs152'."
+        "If the message is flagged, make a determination if it is a serious violation or non-serious violation. Messages with malicious intent or has potential negative impact on the receiver should be classified as serious."
+        "If it is spam, classify it as advertising, invites to other platforms, malicious links, or other."
+        "Additionally, if the message is spam, classify it as serious if it contains any link, Discord invite, or any form of advertising. Otherwise, it is non-serious spam."
+        "Your response should only contain keywords in [Flagged, Not flagged, Spam, Violent, Harrasment, Not safe for work, nsfw, Hate speech, Other, Non-serious, Serious, Advertising, Invites, Links"},
+    {"role": "user", "content": "Join my crypto discord server: https://discord.gg/XYBrZE8x."},
+    {"role": "assistant", "content": "Flagged. Spam. Non-serious. Invites."},
+    {"role": "user", "content": "We should play Call Of Duty Together."},
+    {"role": "assistant", "content": "Not flagged."},
+    {"role": "user", "content": "I'm going to kick your ass."},
+    {"role": "assistant", "content": "Flagged. Violent. Serious."},
+    {"role": "user", "content": "Free entry in 2 a wkly comp to win FA Cup final tkts 21st May 2005. Text FA to 87121 to receive entry question(std txt rate)T&C's apply 08452810075over18's"},
+    {"role": "assistant", "content": "Flagged. Spam. Serious. Advertising."},
+    {"role": "user", "content": "XXXMobileMovieClub: To use your credit, click the WAP link in the next txt message or click here>> http://wap. xxxmobilemovieclub.com?n=QJKGIGHJJGCBL"},
+    {"role": "assistant", "content": "Flagged. Spam. Serious. Links."},
+]
+
+
+def build_messages(message):
+    return PROMPT + [{"role": "user", "content": message}]
+
+
+def request_classification(openai, message):
+    '''
+    Asks the LLM to classify the message, retrying recoverable errors.
+    Returns the raw answer, or None if the LLM couldn't be reached.
+    '''
+    retry = True
+    retries = 0
+    while retry and retries < 5:
+        retries += 1
+        retry = False
+        try:
+            response = openai.ChatCompletion.create(
+                model=MODEL,
+                messages=build_messages(message)
+            )
+
+            output = response['choices'][0]['message']['content']
+
+            print("GPT output: " + output)
+            return output
+
+        except (openai.error.APIError, openai.error.Timeout, openai.error.RateLimitError):
+            retry = True
+            print("Hit a recoverable OpenAI API error. Retrying in 1 second.")
+            time.sleep(1)
+
+        except (openai.error.APIConnectionError, 
+                openai.errors.InvalidRequestError, 
+                openai.errors.AuthenticationError, 
+                openai.errors.ServiceUnavailableError
+                ) as e:
+            print(e)
+            print("Hit unrecoverable OpenAI error. Falling back.")
+    return None
+
+
+def parse_classification(output):
+    '''
+    Turns the LLM's keyword answer into one of our eval types, e.g. "Flagged. Spam. Serious. Links." -> violation_spam_links_serious.
+    '''
+    classifications_list = output.split('. ')
+    if "not flagged" in classifications_list[0].lower() or len(classifications_list) < 2:
+        return "unidentified"
+
+    classifications = output
+    result = ""
+    if "spam" in classifications.lower():
+        if SpamType.ADVERTISING in classifications.lower():
+            result += "violation_spam_advertising"
+        elif SpamType.INVITES in classifications.lower():
+            result += "violation_spam_invites"
+        elif SpamType.MALICIOUS_LINKS in classifications.lower():
+            result += "violation_spam_links"
+        elif SpamType.OTHER in classifications.lower():
+            result += "violation_spam_other"
+        else:
+            result += "violation_spam"
+    elif "violent" in classifications.lower():
+        result += "violation_violent"
+    elif "harassment" in classifications.lower():
+        result += "violation_harassment"
+    elif "not safe for work" in classifications.lower() or "nsfw" in classifications.lower():
+        result += "violation_nsfw"
+    elif "hate speech" in classifications.lower():
+        result += "violation_hate_speech"
+    else:
+        result += "violation_other"
+
+    if "non-serious" in classifications.lower():
+        result += "_minor"
+    elif "serious" in classifications.lower():
+        result += "_serious"
+    return result
+
+
+def fallback_classification(message):
+    '''
+    Keyword matching used when the LLM can't be reached.
+    '''
+    # TBH this should be better. Let's think about how to do this.
+    result = ""
+    if Category.SPAM in message:
+        if SpamType.ADVERTISING in message:
+            result += "violation_spam_advertising"
+        elif SpamType.INVITES in message:
+            result += "violation_spam_invites"
+        elif SpamType.MALICIOUS_LINKS in message:
+            result += "violation_spam_links"
+        elif SpamType.OTHER in message:
+            result += "violation_spam_other"
+        else:
+            result += "violation_spam"
+    elif Category.VIOLENT in message:
+        result += "violation_violent"
+    elif Category.HARASSMENT in message:
+        result += "violation_harassment"
+    elif Category.NSFW in message:
+        result += "violation_nsfw"
+    elif Category.HATE_SPEECH in message:
+        result += "violation_hate speech"
+    elif Category.OTHER in message:
+        result += "violation_other"
+
+    if "serious" in message:
+        result += "_serious"
+    else:
+        result += "_minor"
+    if "violation" in result:
+        return result
+    else:
+        return "unidentified"
+
@@ -0,0 +1,172 @@
+# links.py
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+
+# Anything that looks like a url, with or without a scheme, plus bare discord invites
+URL_PATTERN = re.compile(r'(?:https?://)?(?:[a-z0-9-]+\.)+[a-z]{2,}(?::\d+)?(?:/[^\s<>"\']*)?', re.IGNORECASE)
+INVITE_PATTERN = re.compile(r'(?:discord(?:app)?\.com/invite|discord\.gg)/([a-z0-9-]+)', re.IGNORECASE)
+
+GOOD = "good"
+BAD = "bad"
+
+
+def normalize_link(link):
+    '''
+    Reduces a link to the form we key reputations on. Discord invites become `discord.gg/<code>` whatever domain
+    they were posted with; everything else becomes `<host><path>?<query>` with the scheme, `www.`, port, fragment
+    and trailing slash removed. The query is kept since it often is the content (youtube.com/watch?v=...).
+    '''
+    invite = INVITE_PATTERN.search(link)
+    if invite:
+        return "discord.gg/" + invite.group(1)
+    link = re.sub(r'^[a-z]+://', '', link.strip(), flags=re.IGNORECASE)
+    host, _, rest = link.partition('/')
+    host = host.split(':')[0].lower().rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    path, _, query = rest.split('#')[0].rstrip('.,)').partition('?')
+    path = path.rstrip('/')
+    return host + ('/' + path if path else '') + ('?' + query if query else '')
+
+
+def is_explicit_link(link):
+    '''
+    Bare words like `file.py` or `it.thanks` also match URL_PATTERN; only links with a scheme, `www.` or an
+    invite are clearly meant as links.
+    '''
+    return re.match(r'(?:[a-z]+://|www\.)', link, re.IGNORECASE) is not None or INVITE_PATTERN.search(link) is not None
+
+
+def extract_links(text, explicit_only=False):
+    return [normalize_link(m.group(0)) for m in URL_PATTERN.finditer(text)
+            if not explicit_only or is_explicit_link(m.group(0))]
+
+
+def link_keys(link):
+    '''
+    Every key a link can be blocklisted under, most specific first:
+    the full link, its host and each parent domain of the host (e.g. a.evil.com -> evil.com).
+    '''
+    keys = [link]
+    host = re.split('[/?]', link)[0]
+    labels = host.split('.')
+    for i in range(len(labels) - 1):
+        keys.append('.'.join(labels[i:]))
+    return keys
+
+
+def hash_key(key):
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+
+
+class KnownBadSet:
+    '''
+    Known-bad domains and invites stored as a sorted array of 8-byte hashes. The compiled file is memory-mapped
+    and binary searched in place, so a blocklist of millions of domains costs 8 bytes each and is shared with
+    the page cache rather than loaded into Python objects.
+    '''
+    HASH_SIZE = 8
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.count = 0
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = len(self.map) // self.HASH_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.map[i * self.HASH_SIZE:(i + 1) * self.HASH_SIZE]
+
+    def __contains__(self, key):
+        if not self.count:
+            return False
+        digest = hash_key(key)
+        i = bisect.bisect_left(self, digest)
+        return i < self.count and self[i] == digest
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def compile_blocklist(source_path, compiled_path):
+    '''
+    Turns a text blocklist (one domain or invite per line, '#' comments allowed) into the sorted hash file
+    read by KnownBadSet.
+    '''
+    digests = set()
+    with open(source_path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                digests.add(hash_key(normalize_link(line)))
+    with open(compiled_path, 'wb') as f:
+        for digest in sorted(digests):
+            f.write(digest)
+
+
+class LinkReputation:
+    '''
+    Decides what we already know about the links in a message. The known-bad set comes from a local blocklist,
+    and the verdict cache remembers links moderators judged legitimate, and links a second moderator confirmed bad.
+    '''
+    BLOCKLIST_PATH = "link_blocklist.txt"
+    COMPILED_PATH = "link_blocklist.bin"
+    VERDICTS_PATH = "link_verdicts.json"
+
+    def __init__(self):
+        # Recompile the blocklist whenever the text file is newer than the compiled one
+        if os.path.isfile(self.BLOCKLIST_PATH) and (not os.path.isfile(self.COMPILED_PATH) or
+                os.path.getmtime(self.BLOCKLIST_PATH) > os.path.getmtime(self.COMPILED_PATH)):
+            compile_blocklist(self.BLOCKLIST_PATH, self.COMPILED_PATH)
+        self.known_bad = KnownBadSet(self.COMPILED_PATH)
+        self.verdicts = {}
+        if os.path.isfile(self.VERDICTS_PATH):
+            with open(self.VERDICTS_PATH) as f:
+                self.verdicts = json.load(f)
+
+    def blocklisted(self, text):
+        '''
+        Whether any link in the text is on the blocklist. Only the curated blocklist is used here, not moderator
+        verdicts, since eval_text flags these messages without asking the LLM.
+        '''
+        return any(key in self.known_bad for link in extract_links(text) for key in link_keys(link))
+
+    def check(self, text):
+        '''
+        Returns BAD if any link in the text is blocklisted or was confirmed bad by moderators, GOOD if every link
+        has been judged legitimate before, and None if the text has no links or at least one of them is new to us.
+        '''
+        if self.blocklisted(text):
+            return BAD
+        links = extract_links(text, explicit_only=True)
+        if not links:
+            return None
+        verdicts = [self.verdicts.get(link) for link in links]
+        if BAD in verdicts:
+            return BAD
+        if all(verdict == GOOD for verdict in verdicts):
+            return GOOD
+        return None
+
+    def record(self, text, legitimate):
+        '''
+        Remembers a moderator's verdict for every explicit link in the text.
+        '''
+        links = extract_links(text, explicit_only=True)
+        if not links:
+            return
+        for link in links:
+            self.verdicts[link] = GOOD if legitimate else BAD
+        with open(self.VERDICTS_PATH, "w") as f:
+            json.dump(self.verdicts, f)
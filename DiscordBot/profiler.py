@@ -0,0 +1,147 @@
+# profiler.py
+import asyncio
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class LiveProfiler:
+    '''
+    A profiler that moderators can turn on for a few seconds in production. A background thread samples the
+    event loop thread's stack and writes the samples as collapsed stacks (the input format of flamegraph.pl and
+    speedscope). A heartbeat coroutine tracks event loop stalls: stacks sampled while the heartbeat is late are
+    counted as slow callbacks. Awaits wrapped in `timed` are summarized too. Allocation sites are only traced on
+    request since tracemalloc slows down every allocation while it runs.
+    '''
+    PROFILE_KEYWORD = "profile"
+    OUTPUT_DIR = "profiles"
+    SAMPLE_INTERVAL = 0.005     # seconds between stack samples
+    HEARTBEAT_INTERVAL = 0.01   # seconds between event loop heartbeats
+    SLOW_CALLBACK = 0.1         # a heartbeat this late means a callback is blocking the loop
+    MAX_SECONDS = 300
+    TOP = 10
+
+    def __init__(self):
+        self.active = False
+        self.task = None
+        self.loop_thread_id = None
+        self.stacks = collections.Counter()
+        self.slow_stacks = collections.Counter()
+        self.awaits = collections.defaultdict(list)
+        self.max_stall = 0.0
+        self.last_beat = 0.0
+        self.stop_event = threading.Event()
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, seconds, trace_allocations=False):
+        '''
+        Profiles for `seconds` and returns a task resolving to (stacks path, summary path, summary).
+        '''
+        self.loop_thread_id = threading.get_ident()
+        self.stacks.clear()
+        self.slow_stacks.clear()
+        self.awaits.clear()
+        self.max_stall = 0.0
+        self.stop_event.clear()
+        self.task = asyncio.create_task(self.run(min(seconds, self.MAX_SECONDS), trace_allocations))
+        return self.task
+
+    def stop(self):
+        self.stop_event.set()
+
+    async def run(self, seconds, trace_allocations):
+        if trace_allocations:
+            tracemalloc.start()
+        self.active = True
+        self.last_beat = time.monotonic()
+        sampler = threading.Thread(target=self.sample, daemon=True)
+        sampler.start()
+        started = time.monotonic()
+        try:
+            while time.monotonic() - started < seconds and not self.stop_event.is_set():
+                before = time.monotonic()
+                await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+                self.last_beat = time.monotonic()
+                self.max_stall = max(self.max_stall, self.last_beat - before - self.HEARTBEAT_INTERVAL)
+        except asyncio.CancelledError:
+            if trace_allocations:
+                tracemalloc.stop()
+            raise
+        finally:
+            self.active = False
+            self.stop_event.set()
+            sampler.join()
+        elapsed = time.monotonic() - started
+        # Building the snapshot statistics and writing the files can take a while, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        allocations = await loop.run_in_executor(None, self.allocation_stats) if trace_allocations else None
+        return await loop.run_in_executor(None, self.write, elapsed, allocations)
+
+    def allocation_stats(self):
+        try:
+            return tracemalloc.take_snapshot().statistics('lineno')[:self.TOP]
+        finally:
+            tracemalloc.stop()
+
+    def sample(self):
+        while not self.stop_event.wait(self.SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack = ';'.join(reversed(stack))
+            self.stacks[stack] += 1
+            if time.monotonic() - self.last_beat > self.SLOW_CALLBACK:
+                self.slow_stacks[stack] += 1
+
+    @contextlib.asynccontextmanager
+    async def timed(self, name):
+        '''
+        Records how long the wrapped await took, but only while a profile is running.
+        '''
+        if not self.active:
+            yield
+            return
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.awaits[name].append(time.monotonic() - started)
+
+    def write(self, elapsed, allocations):
+        os.makedirs(self.OUTPUT_DIR, exist_ok=True)
+        path = os.path.join(self.OUTPUT_DIR, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+        with open(path, "w") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+        summary = f"Profiled {elapsed:.1f}s, {sum(self.stacks.values())} samples, longest loop stall {self.max_stall * 1000:.0f}ms\n"
+        summary += "\nSlow callbacks (samples while the loop was blocked):\n"
+        for stack, count in self.slow_stacks.most_common(self.TOP):
+            summary += f"  {count * self.SAMPLE_INTERVAL * 1000:.0f}ms {stack.split(';')[-1]}\n"
+        summary += "\nLongest awaits:\n"
+        for name, durations in sorted(self.awaits.items()):
+            durations.sort()
+            summary += f"  {name}: {len(durations)} calls, max {durations[-1] * 1000:.0f}ms, median {durations[len(durations) // 2] * 1000:.0f}ms\n"
+        if allocations is None:
+            summary += "\nAllocation sites were not traced, use `profile <seconds> alloc` to include them.\n"
+        else:
+            summary += "\nTop allocation sites:\n"
+            for stat in allocations:
+                frame = stat.traceback[0]
+                summary += f"  {stat.size / 1024:.1f}KiB in {stat.count} blocks at {os.path.basename(frame.filename)}:{frame.lineno}\n"
+
+        summary_path = path[:-len(".folded")] + ".txt"
+        with open(summary_path, "w") as f:
+            f.write(summary)
+        return path, summary_path, summary
@@ -67,6 +67,8 @@ class Report:
         self.eval_type = None
         self.id = client.next_id()
         self.priority_score = 0.0
+        self.link_legit = None
+        self.classifying = False  # set while the bot classifies a completed report, before moderators can see it
         
     async def handle_message(self, message):
         '''
@@ -99,7 +101,8 @@ class Report:
             if not channel:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
-                message = await channel.fetch_message(int(m.group(3)))
+                async with self.client.profiler.timed("fetch_message"):
+                    message = await channel.fetch_message(int(m.group(3)))
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
 
@@ -197,7 +200,8 @@ class Report:
             if not channel:
                 return ["It seems this channel was deleted or never existed. Please try again or say `done` to proceed with finishing the report."]
             try:
-                add_msg = await channel.fetch_message(int(m.group(3)))
+                async with self.client.profiler.timed("fetch_message"):
+                    add_msg = await channel.fetch_message(int(m.group(3)))
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `done` to proceed with finishing the report."]
             if add_msg.author.id != self.reported_author_id:
@@ -0,0 +1,113 @@
+# scheduler.py
+import asyncio
+import logging
+import random
+import time
+
+
+class Lane:
+    '''
+    A lane is a set of bounded queues, each drained by its own worker. Events are routed to a queue by key
+    (the author id), so one user's messages are still handled in order while different users run in parallel.
+    '''
+    def __init__(self, name, workers, max_size, shed=False, sample_threshold=1.0, sample_rate=1.0):
+        self.name = name
+        self.shed = shed                            # drop events instead of waiting when the lane is full
+        self.sample_threshold = sample_threshold    # fraction of capacity above which events are sampled
+        self.sample_rate = sample_rate              # fraction of events kept while sampling
+        self.queues = [asyncio.Queue(maxsize=max(1, max_size // workers)) for _ in range(workers)]
+        self.tasks = []
+        self.handled = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def queued(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def capacity(self):
+        return sum(queue.maxsize for queue in self.queues)
+
+    def admit(self, queue):
+        if not self.shed:
+            return True
+        if queue.full():
+            return False
+        if self.queued() >= self.sample_threshold * self.capacity():
+            return random.random() < self.sample_rate
+        return True
+
+    async def put(self, key, handler, *args):
+        queue = self.queues[hash(key) % len(self.queues)]
+        if not self.admit(queue):
+            self.dropped += 1
+            return False
+        # Lanes that don't shed apply backpressure: the caller waits until there is room
+        await queue.put((time.monotonic(), handler, args))
+        return True
+
+    async def work(self, queue):
+        while True:
+            enqueued, handler, args = await queue.get()
+            wait = time.monotonic() - enqueued
+            self.handled += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                await handler(*args)
+            except Exception:
+                # Handlers used to run straight from on_message, where discord.py logged the traceback for us
+                logging.getLogger('discord').exception(f"Error handling event in the {self.name} lane")
+            finally:
+                queue.task_done()
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work(queue)) for queue in self.queues]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def status(self):
+        avg_wait = self.total_wait / self.handled if self.handled else 0.0
+        return (f"{self.name}: {self.queued()}/{self.capacity()} queued, {self.handled} handled, {self.dropped} dropped, "
+                f"wait avg {avg_wait * 1000:.1f}ms max {self.max_wait * 1000:.1f}ms")
+
+
+class IngressScheduler:
+    '''
+    Splits incoming events into lanes so that a flood of channel messages can't delay moderators.
+    Mod commands and DM report flows always wait for room; channel scans are sampled and then shed
+    once their lane fills up.
+    '''
+    MOD = "mod"
+    DM = "dm"
+    CHANNEL = "channel"
+    STATUS_KEYWORD = "lanes"
+
+    def __init__(self):
+        self.lanes = {
+            self.MOD: Lane(self.MOD, workers=2, max_size=100),
+            self.DM: Lane(self.DM, workers=4, max_size=200),
+            self.CHANNEL: Lane(self.CHANNEL, workers=4, max_size=400, shed=True, sample_threshold=0.75, sample_rate=0.25),
+        }
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        for lane in self.lanes.values():
+            lane.start()
+        self.started = True
+
+    def stop(self):
+        for lane in self.lanes.values():
+            lane.stop()
+        self.started = False
+
+    async def submit(self, lane, key, handler, *args):
+        return await self.lanes[lane].put(key, handler, *args)
+
+    def status(self):
+        return "\n".join(lane.status() for lane in self.lanes.values())
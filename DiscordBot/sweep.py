@@ -0,0 +1,132 @@
+# sweep.py
+import asyncio
+import json
+import logging
+import os
+import time
+import discord
+from scheduler import IngressScheduler
+
+
+class HistorySweep:
+    '''
+    Streams the history of a single channel through the bot's classifier so that messages sent before the bot
+    joined (or before a rule changed) are checked too. Messages are pulled page by page from `channel.history()`
+    and handled one at a time, so memory stays bounded no matter how long the channel is. The id of the last
+    message handled is written to a checkpoint file so an interrupted sweep picks up where it left off;
+    `restart` clears it to sweep the whole channel again, e.g. after a rule change.
+    '''
+    SWEEP_KEYWORD = "sweep"
+    CHECKPOINT_PATH = "sweep_checkpoints.json"
+    DELAY = 0.5                 # seconds to wait between classifications so live traffic goes first
+    BUSY_DELAY = 2.0            # seconds to back off while live channel messages are waiting to be scanned
+    PROGRESS_EVERY = 50         # send a progress update to the mod channel every N messages
+    CHECKPOINT_EVERY = 10       # write the checkpoint every N messages
+
+    def __init__(self, client, channel, mod_channel, restart=False):
+        self.client = client
+        self.channel = channel
+        self.mod_channel = mod_channel
+        self.task = None
+        self.scanned = 0
+        self.flagged = 0
+        self.new_reports = []       # ids of reports queued since the last progress message
+        self.started = None
+        if restart:
+            self.clear_checkpoint()
+        self.last_message_id = load_checkpoints().get(str(channel.id))
+
+    def start(self):
+        self.started = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def throughput(self):
+        if self.started is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started
+        return self.scanned / elapsed if elapsed > 0 else 0.0
+
+    def status(self):
+        return f"Sweep of #{self.channel.name}: {self.scanned} scanned, {self.flagged} flagged, {self.throughput():.2f} msg/s"
+
+    def progress(self):
+        # New reports are announced together with progress instead of one message each, so a sweep over a
+        # raided channel doesn't flood the mod channel
+        status = self.status()
+        if self.new_reports:
+            status += "\nReports requiring moderation: " + ", ".join(str(report_id) for report_id in self.new_reports)
+            self.new_reports = []
+        return status
+
+    async def throttle(self):
+        lane = self.client.scheduler.lanes[IngressScheduler.CHANNEL]
+        while lane.queued() > 0:
+            await asyncio.sleep(self.BUSY_DELAY)
+        await asyncio.sleep(self.DELAY)
+
+    async def run(self):
+        after = discord.Object(id=int(self.last_message_id)) if self.last_message_id else None
+        if after:
+            await self.mod_channel.send(f"Resuming sweep of #{self.channel.name} after message {self.last_message_id}.")
+        else:
+            await self.mod_channel.send(f"Starting sweep of #{self.channel.name}.")
+        try:
+            # history() is an async iterator that fetches one page (100 messages) at a time, so only one page is held
+            async for message in self.channel.history(limit=None, after=after, oldest_first=True):
+                await self.handle_message(message)
+                if self.scanned % self.CHECKPOINT_EVERY == 0:
+                    self.save_checkpoint()
+                if self.scanned % self.PROGRESS_EVERY == 0:
+                    await self.mod_channel.send(self.progress())
+                await self.throttle()
+        except asyncio.CancelledError:
+            self.save_checkpoint()
+            await self.mod_channel.send("Sweep stopped. " + self.progress())
+            raise
+        except Exception as e:
+            logging.getLogger('discord').exception(f"Sweep of #{self.channel.name} failed")
+            self.save_checkpoint()
+            await self.mod_channel.send(f"Sweep failed: {e!r}. " + self.progress())
+            return
+        self.save_checkpoint()
+        await self.mod_channel.send("Sweep complete. " + self.progress())
+
+    async def handle_message(self, message):
+        # The checkpoint only moves past a message once it has been classified, so a cancelled sweep retries it
+        if message.author.id != self.client.user.id and message.content:
+            eval_type = await self.client.classify(message.content)
+            if "violation" in eval_type:
+                self.flagged += 1
+                report = self.client.queue_flagged_message(message, eval_type, self.mod_channel)
+                self.new_reports.append(report.id)
+        self.scanned += 1
+        self.last_message_id = message.id
+
+    def save_checkpoint(self):
+        if self.last_message_id is None:
+            return
+        checkpoints = load_checkpoints()
+        checkpoints[str(self.channel.id)] = self.last_message_id
+        with open(self.CHECKPOINT_PATH, "w") as f:
+            json.dump(checkpoints, f)
+
+    def clear_checkpoint(self):
+        checkpoints = load_checkpoints()
+        if checkpoints.pop(str(self.channel.id), None) is not None:
+            with open(self.CHECKPOINT_PATH, "w") as f:
+                json.dump(checkpoints, f)
+
+
+def load_checkpoints():
+    if not os.path.isfile(HistorySweep.CHECKPOINT_PATH):
+        return {}
+    with open(HistorySweep.CHECKPOINT_PATH) as f:
+        return json.load(f)